@@ -13,7 +13,9 @@ import datetime
 from io import BytesIO
 import zipfile
 import calendar
+import numpy as np
 import plotly.express as px
+import xxhash
 
 
 # ==============================================================================
@@ -52,21 +54,79 @@ def normalize_columns(df, column_map):
                 rename_dict[aliases] = aliases
     return df.rename(columns=rename_dict)
 
+# أعمدة الأكواد تقرأ كنصوص والكميات كأرقام عشرية
+CODE_COLUMNS = [col("material"), col("component")]
+QUANTITY_COLUMNS = [col("component_qty"), col("current_stock")]
+
+# أعمدة التصنيف المتكررة تتحول إلى category لتسريع التجميع والدمج والفلترة
+CATEGORY_COLUMNS = [
+    col("material"), col("component"), col("order_type"),
+    col("component_order_type"), col("hierarchy_level"), col("mrp_controller")
+]
+
+def code_to_str(value):
+    # الأكواد الرقمية تقرأ أحياناً كأرقام عشرية (100000.0) فتتحول لنص بدون الكسر
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return value if value is None or isinstance(value, str) else str(value)
+
+def apply_categories(*dfs):
+    # فئات موحدة لنفس العمود في كل الجداول حتى يتم الدمج على أكواد رقمية
+    for c in CATEGORY_COLUMNS:
+        frames = [df for df in dfs if c in df.columns]
+        if not frames:
+            continue
+        # القيم الأصلية بدون تحويل لنص حتى يبقى المستوى الهرمي رقماً في الترتيب والتصدير
+        categories = pd.Index(pd.concat([df[c] for df in frames]).dropna().unique())
+        # الفئات مرتبة حسب القيمة حتى تخرج الصفوف والأعمدة بنفس ترتيب التجميع العادي
+        try:
+            categories = categories.sort_values()
+        except TypeError:
+            # عمود مختلط (أرقام ونصوص) يرتب كنص
+            categories = categories[categories.astype(str).argsort()]
+        dtype = pd.CategoricalDtype(categories)
+        for df in frames:
+            df[c] = df[c].astype(dtype)
+
+def apply_dtypes(df, date_cols=()):
+    for c in CODE_COLUMNS:
+        if c in df.columns:
+            df[c] = df[c].map(code_to_str, na_action="ignore").astype("string")
+    for c in QUANTITY_COLUMNS + list(date_cols):
+        if c in df.columns:
+            df[c] = pd.to_numeric(df[c], errors='coerce').astype("float64")
+    return df
+
+def present_codes(series):
+    # أكواد الـ category الموجودة فعلاً في العمود (بدون القيم الفارغة -1)
+    codes = series.cat.codes.unique()
+    return codes[codes >= 0]
+
+def file_digest(file_bytes):
+    # بصمة محتوى الملف تستخدم كمفتاح للكاش بدل كائن الرفع نفسه
+    return xxhash.xxh3_64(file_bytes).hexdigest()
+
 @st.cache_data
-def load_and_validate_data(uploaded_file):
+def load_and_validate_data(digest, _file_bytes):
     try:
-        xls = pd.ExcelFile(uploaded_file, engine='openpyxl')
+        xls = pd.ExcelFile(BytesIO(_file_bytes), engine="calamine")
 
         required_sheets = ["plan", "Component"]
         missing_sheets = [sheet for sheet in required_sheets if sheet not in xls.sheet_names]
         if missing_sheets:
             st.error(f"❌ الملف لا يحتوي على الأوراق المطلوبة: {', '.join(missing_sheets)}")
             st.stop()
-            
+
         plan_df = normalize_columns(xls.parse("plan"), COLUMN_NAMES)
         component_df = normalize_columns(xls.parse("Component"), COLUMN_NAMES)
         mrp_df = normalize_columns(xls.parse("MRP Contor"), COLUMN_NAMES) if "MRP Contor" in xls.sheet_names else pd.DataFrame()
 
+        # التواريخ تقرأ من رأس الجدول مرة واحدة
+        plan_date_cols = [c for c in plan_df.columns if isinstance(c, (datetime.datetime, pd.Timestamp))]
+        plan_df = apply_dtypes(plan_df, plan_date_cols)
+        component_df = apply_dtypes(component_df)
+        mrp_df = apply_dtypes(mrp_df)
+
         # التحقق من الأعمدة الأساسية
         required_plan_columns = [col("material"), col("material_desc"), col("order_type")]
         if not all(c in plan_df.columns for c in required_plan_columns):
@@ -88,6 +148,8 @@ def load_and_validate_data(uploaded_file):
         if col("hierarchy_level") not in component_df.columns:
             component_df[col("hierarchy_level")] = "غير محدد"
 
+        apply_categories(plan_df, component_df, mrp_df)
+
         return plan_df, component_df, mrp_df
 
     except Exception as e:
@@ -95,6 +157,309 @@ def load_and_validate_data(uploaded_file):
         st.stop()
 
 
+def build_mrp_map(mrp_df):
+    return mrp_df.set_index("Component")["MRP Contor"].to_dict() if not mrp_df.empty else {}
+
+# مثل compute_pipeline: حد لعدد النسخ في الذاكرة
+@st.cache_data(persist="disk", max_entries=10)
+def build_bom_pivot(digest, _merged_df, _mrp_df):
+    # جدول المكونات في الـ BOMs يستخدم في التصدير فقط فيحسب عند الضغط على الزر
+    if _mrp_df.empty:
+        return None
+
+    merged_df = _merged_df.assign(**{"MRP Contor": _merged_df["Component"].map(build_mrp_map(_mrp_df))})
+
+    bom_keys = ["MRP Contor", "Component", "Material", "Component Order Type"]
+    component_bom_map = merged_df.groupby(bom_keys, observed=True)["Planned Quantity"].sum().to_frame()
+
+    # حذف التكرار أولاً حتى يعمل الـ join على القيم المختلفة فقط
+    component_bom_map["Order Type"] = merged_df.drop_duplicates(bom_keys + ["Order Type"]).groupby(
+        bom_keys, observed=True
+    )["Order Type"].agg(lambda g: ','.join(sorted(g)))
+    component_bom_map = component_bom_map.reset_index()
+
+    # astype(str) لأن pandas يعيد نتيجة الـ join إلى category إذا كانت كل القيم نوع طلب واحد
+    # الكمية float دائماً بعد مصفوفة الخطة، فالقيم الصحيحة تكتب بدون .0 مثل الأصل
+    component_bom_map["OrderType_Quantity"] = component_bom_map["Order Type"].astype(str) + " (" + component_bom_map["Planned Quantity"].map(code_to_str) + ")"
+
+    # كل (مكون، موديل) له سطر واحد بعد التجميع فيكفي unstack بدون دالة تجميع
+    component_bom_pivot = component_bom_map.set_index(
+        ["MRP Contor", "Component", "Component Order Type", "Material"]
+    )["OrderType_Quantity"].unstack("Material", fill_value="").sort_index(axis=1)
+    return component_bom_pivot
+
+# max_entries يحد عدد الملفات المحفوظة في الذاكرة (ttl غير مدعوم مع persist="disk")
+@st.cache_data(persist="disk", max_entries=10)
+def compute_pipeline(digest, _plan_df, _component_df, _mrp_df):
+    # الحسابات الثقيلة (بدون الفلاتر) تحسب مرة واحدة لكل ملف
+    plan_df, component_df, mrp_df = _plan_df, _component_df, _mrp_df
+    date_cols = [c for c in plan_df.columns if isinstance(c, (datetime.datetime, pd.Timestamp))]
+
+    # خريطة المكون ← MRP Contor تبنى مرة واحدة وتستخدم بدل تكرار الدمج
+    mrp_map = build_mrp_map(mrp_df)
+
+    # -------------------------------
+    # تجهيز البيانات الأساسية
+    # -------------------------------
+    # مصفوفة الخطة (موديل × تاريخ) تضرب مباشرة في كميات المكونات بدل melt + merge على كل التواريخ
+    plan_mat = plan_df[date_cols].to_numpy(dtype=np.float64, na_value=0.0)
+
+    # ربط كل سطر BOM بسطر الخطة الخاص به (بدون أعمدة التواريخ)
+    plan_keys = plan_df[["Material", "Material Description", "Order Type"]].assign(plan_row=np.arange(len(plan_df)))
+    merged_df = pd.merge(plan_keys, component_df, on="Material", how="inner")
+    plan_rows = merged_df.pop("plan_row").to_numpy()
+
+    # الاحتياج لكل سطر BOM ولكل تاريخ (سطور BOM × التواريخ)
+    required = merged_df["Component Quantity"].to_numpy(dtype=np.float64, na_value=0.0)[:, None] * plan_mat[plan_rows]
+    merged_df["Planned Quantity"] = plan_mat[plan_rows].sum(axis=1)
+    merged_df["Required Component Quantity"] = required.sum(axis=1)
+
+    # تجميع السطور حسب المفاتيح مرة واحدة ثم اشتقاق باقي الجداول منه
+    component_keys = ["Component", "Component Description", "Component UoM", "Current Stock", "Component Order Type"]
+    base_keys = component_keys + ["Hierarchy Level", "Order Type"]
+    group_codes = merged_df.groupby(base_keys, observed=True, sort=False, dropna=False).ngroup().to_numpy()
+    first_rows = ~pd.Series(group_codes).duplicated().to_numpy()
+
+    base_values = np.zeros((first_rows.sum(), len(date_cols)))
+    np.add.at(base_values, group_codes, required)
+    base = pd.DataFrame(
+        base_values,
+        index=pd.MultiIndex.from_frame(merged_df.loc[first_rows, base_keys]),
+        columns=pd.DatetimeIndex(date_cols)
+    )
+
+    # تجميع واحد حسب (المكون، نوع الأمر) والتواريخ أعمدة بالفعل، فيشتق منه الجدولان بدون pivot_table
+    by_order = base.groupby(level=component_keys + ["Order Type"], observed=True, dropna=False).sum()
+
+    # -------------------------------
+    # Need_By_Date
+    # -------------------------------
+    pivot_by_date = by_order.groupby(level=component_keys, observed=True).sum().reset_index()
+
+    if not mrp_df.empty:
+        pivot_by_date["MRP Contor"] = pivot_by_date["Component"].map(mrp_map)
+
+        # إعادة ترتيب الأعمدة
+        cols = pivot_by_date.columns.tolist()
+        fixed_order = ["Component", "Component Description", "MRP Contor", "Component UoM", "Current Stock", "Component Order Type"]
+        other_cols = [c for c in cols if c not in fixed_order]
+        pivot_by_date = pivot_by_date[fixed_order + other_cols]
+
+    # تنسيق أسماء الأعمدة (التواريخ تبقى dd mmm)
+    pivot_by_date.columns = [
+        col.strftime("%d %b") if isinstance(col, pd.Timestamp) else col
+        for col in pivot_by_date.columns
+    ]
+
+    # -------------------------------
+    # Need_By_Order Type
+    # -------------------------------
+    pivot_by_order = (
+        by_order[by_order.index.to_frame().notna().all(axis=1).to_numpy()]
+        .unstack("Order Type", fill_value=0)
+        .sort_index(axis=1)
+        .reset_index()
+    )
+
+    pivot_by_order.columns = [
+        f"{col[1][0]} - {col[0].strftime('%d %b')}" if isinstance(col, tuple) and isinstance(col[0], pd.Timestamp)
+        else col if isinstance(col, str) else col[0]
+        for col in pivot_by_order.columns
+    ]
+
+    # 🔹 إضافة عمود MRP Contor
+    if not mrp_df.empty:
+        pivot_by_order["MRP Contor"] = pivot_by_order["Component"].map(mrp_map)
+
+    # -------------------------------
+    # تحليل الرصيد والمكونات الحرجة
+    # -------------------------------
+    # حساب إجمالي الاحتياج والرصيد لكل مكون
+    component_analysis = base.sum(axis=1).rename("Required Component Quantity").reset_index(level="Order Type").groupby(
+        level=component_keys + ["Hierarchy Level"], observed=True
+    ).agg({
+        "Required Component Quantity": "sum",
+        "Order Type": lambda x: ", ".join(sorted(set(x)))
+    }).reset_index()
+
+    # دمج بيانات MRP Contor إذا كانت موجودة
+    if not mrp_df.empty:
+        component_analysis["MRP Contor"] = component_analysis["Component"].map(mrp_map)
+        # استبدال القيم الفارغة بـ "غير محدد"
+        component_analysis["MRP Contor"] = component_analysis["MRP Contor"].astype("string").fillna("غير محدد").astype("category")
+    else:
+        component_analysis["MRP Contor"] = "غير محدد"
+
+    # حساب نسبة التغطية
+    component_analysis["Coverage Percentage"] = (component_analysis["Current Stock"] / component_analysis["Required Component Quantity"] * 100).round(1)
+    coverage = component_analysis["Coverage Percentage"].to_numpy()
+    required_qty = component_analysis["Required Component Quantity"].to_numpy()
+    component_analysis["Coverage Status"] = np.select(
+        [coverage >= 100, coverage >= 50],
+        ["🟢 كافية", "🟡 جزئية"],
+        default="🔴 غير كافية"
+    )
+
+    # تحديد الأولوية بناء على نسبة التغطية والكمية المطلوبة
+    component_analysis["Priority"] = np.select(
+        [(coverage < 30) & (required_qty > 1000), coverage < 50],
+        ["🔥 عاجل", "⚠️ متوسط"],
+        default="✅ منخفض"
+    )
+
+    # تسمية مختصرة (الكود + أول 20 حرف من الوصف) للرسوم البيانية، منفصلة حتى لا تظهر في التصدير
+    short_labels = (
+        component_analysis["Component"].astype(str) + " - "
+        + component_analysis["Component Description"].astype(str).str.slice(0, 20)
+    )
+
+    return {
+        "merged_df": merged_df,
+        "pivot_by_date": pivot_by_date,
+        "pivot_by_order": pivot_by_order,
+        "component_analysis": component_analysis,
+        "short_labels": short_labels
+    }
+
+# أعمدة الفلاتر في جدول تحليل التغطية
+FILTER_COLUMNS = [col("mrp_controller"), col("component_order_type"), col("hierarchy_level")]
+
+@st.cache_data(max_entries=10)
+def build_filter_masks(digest, _component_analysis):
+    # قناع (bitmask) مضغوط لكل قيمة في كل عمود فلتر يحسب مرة واحدة لكل ملف
+    masks = {}
+    for c in FILTER_COLUMNS:
+        values = _component_analysis[c].astype("category")
+        codes = values.cat.codes.to_numpy()
+        masks[c] = {v: np.packbits(codes == i) for i, v in enumerate(values.cat.categories)}
+    return masks
+
+def apply_filter_masks(masks, selections, n_rows):
+    # OR بين القيم المختارة داخل نفس الفلتر ثم AND بين الفلاتر
+    empty = np.zeros((n_rows + 7) // 8, dtype=np.uint8)
+    packed = np.bitwise_and.reduce([
+        np.bitwise_or.reduce([masks[c][v] for v in selected if v in masks[c]] or [empty])
+        for c, selected in selections.items()
+    ])
+    return np.unpackbits(packed, count=n_rows).astype(bool)
+
+
+# الرسوم البيانية تحفظ في الكاش لكل ملف ولكل حالة فلاتر
+# مع حد لعدد الحالات المحفوظة حتى لا تتراكم الرسوم مع كل تجربة فلاتر جديدة
+FIG_CACHE_ENTRIES = 50
+
+@st.cache_data(max_entries=FIG_CACHE_ENTRIES)
+def make_fig_coverage(digest, mrp_tup, ot_tup, lvl_tup, _df):
+    fig_coverage = px.pie(
+        _df, 
+        names="Coverage Status", 
+        title="توزيع المكونات حسب حالة التغطية",
+        color="Coverage Status",
+        color_discrete_map={"🟢 كافية": "green", "🟡 جزئية": "orange", "🔴 غير كافية": "red"}
+    )
+    return fig_coverage
+
+@st.cache_data(max_entries=FIG_CACHE_ENTRIES)
+def make_fig_critical(digest, mrp_tup, ot_tup, lvl_tup, _df, _short_labels):
+    top_critical = _df.nsmallest(10, "Coverage Percentage")
+    if top_critical.empty:
+        return None
+
+    # التسمية المختصرة محسوبة مسبقاً مع جدول التحليل
+    top_critical = top_critical.assign(Short_Label=_short_labels.loc[top_critical.index])
+
+    # ترتيب المكونات حسب كمية الطلب (من الأكبر إلى الأصغر)
+    top_critical = top_critical.sort_values("Required Component Quantity", ascending=True)
+
+    fig_critical = px.bar(
+        top_critical,
+        y="Short_Label",  # التسمية المختصرة على المحور Y
+        x="Required Component Quantity",  # كمية الطلب على المحور X
+        color="Coverage Percentage",  # التلوين حسب نسبة التغطية
+        orientation='h',  # رسم أفقي
+        title="أقل 10 مكونات في نسبة التغطية (مرتبة حسب كمية الطلب)",
+        labels={
+            "Required Component Quantity": "كمية الطلب المطلوبة", 
+            "Short_Label": "المكون", 
+            "Coverage Percentage": "نسبة التغطية %",
+            "MRP Contor": "MRP Controller"
+        },
+        hover_data={
+            "Component": True,
+            "Component Description": True,
+            "Current Stock": True,
+            "Coverage Percentage": ":.1f",
+            "MRP Contor": True,
+            "Component Order Type": True
+        },
+        color_continuous_scale="RdYlGn_r"  # مقياس ألوان عكسي (أحمر للأقل تغطية)
+    )
+
+    # تخصيص التنسيق
+    fig_critical.update_traces(
+        hovertemplate=(
+            "<b>%{customdata[0]}</b><br>"
+            "الوصف: %{customdata[1]}<br>"
+            "الرصيد الحالي: %{customdata[2]:,}<br>"
+            "الطلب المطلوب: %{x:,}<br>"
+            "نسبة التغطية: %{customdata[3]:.1f}%<br>"
+            "MRP Controller: %{customdata[4]}<br>"
+            "نوع الطلب: %{customdata[5]}"
+        )
+    )
+
+    # تحسين تخطيط الرسم البياني
+    fig_critical.update_layout(
+        yaxis={'categoryorder':'total ascending'},  # ترتيب حسب القيمة
+        xaxis_title="كمية الطلب المطلوبة",
+        yaxis_title="المكون",
+        hovermode="closest",
+        coloraxis_colorbar=dict(title="نسبة التغطية %"),
+        height=500  # زيادة الارتفاع لعرض أفضل
+    )
+
+    # إضافة تسميات القيم على الأعمدة
+    fig_critical.update_traces(
+        text=top_critical["Required Component Quantity"].apply(lambda x: f"{x:,.0f}"),
+        textposition='outside'
+    )
+    return fig_critical
+
+@st.cache_data(max_entries=FIG_CACHE_ENTRIES)
+def make_fig_mrp_coverage(digest, mrp_tup, ot_tup, lvl_tup, _df):
+    fig_mrp_coverage = px.sunburst(
+        _df,
+        path=['MRP Contor', 'Coverage Status'],
+        values='Required Component Quantity',
+        title='توزيع المكونات حسب MRP Contor وحالة التغطية'
+    )
+    return fig_mrp_coverage
+
+@st.cache_data(max_entries=FIG_CACHE_ENTRIES)
+def make_fig_order_type(digest, mrp_tup, ot_tup, lvl_tup, _df):
+    fig_order_type = px.pie(
+        _df, 
+        names="Component Order Type", 
+        title="توزيع المكونات حسب نوع الطلب",
+        color="Component Order Type"
+    )
+    return fig_order_type
+
+@st.cache_data(max_entries=10)
+def make_fig_monthly(digest, _pivot_df):
+    fig = px.bar(
+        _pivot_df, 
+        x="Month", 
+        y=["E", "L"], 
+        barmode="group", 
+        text_auto=True, 
+        title="رسم بياني لتوزيع الكميات",
+        labels={"value": "الكمية", "variable": "نوع الأمر", "Month": "الشهر"},
+        template="streamlit"
+    )
+    return fig
+
+
 # ==============================================================================
 # 4. واجهة المستخدم الرئيسية للتطبيق
 # ==============================================================================
@@ -134,59 +499,60 @@ st.markdown("<p style='font-size:16px; font-weight:bold;'>📂 اختر ملف 
 uploaded_file = st.file_uploader("", type=["xlsx"])
 
 if uploaded_file:
-    plan_df, component_df, mrp_df = load_and_validate_data(uploaded_file)
-    plan_df_orig = plan_df.copy()
-    component_df_orig = component_df.copy()
-    mrp_df_orig = mrp_df.copy()
+    file_bytes = uploaded_file.getvalue()
+    digest = file_digest(file_bytes)
+    plan_df, component_df, mrp_df = load_and_validate_data(digest, file_bytes)
 
     # أي معالجة أو جداول Pivot بعد كده...
 
     # استخراج أعمدة التواريخ مرة واحدة
     date_cols = [c for c in plan_df.columns if isinstance(c, (datetime.datetime, pd.Timestamp))]
-    
-    # نسخة معالجة
-    plan_df_processed = plan_df.copy()
 
     # 🔹 إجبار أعمدة الأكواد إنها تبقى نصوص لتفادي الفواصل
 
     with st.spinner("⏳ جاري معالجة البيانات وعرض النتائج..."):
         # (نفس الحسابات والجداول والرسوم البيانية الموجودة في كودك الأصلي بدون تعديل)
-         # -------------------------------
-        # تجهيز البيانات الأساسية
         # -------------------------------
-        plan_melted = plan_df.melt(
-            id_vars=["Material", "Material Description", "Order Type"],
-            var_name="Date",
-            value_name="Planned Quantity"
-        )
-        plan_melted["Date"] = pd.to_datetime(plan_melted["Date"], errors='coerce')
-        merged_df = pd.merge(plan_melted, component_df, on="Material", how="left")
-        merged_df["Required Component Quantity"] = merged_df["Planned Quantity"] * merged_df["Component Quantity"]
+        # تجهيز البيانات الأساسية (من الكاش لنفس الملف)
+        # -------------------------------
+        results = compute_pipeline(digest, plan_df, component_df, mrp_df)
+        merged_df = results["merged_df"]
+        pivot_by_date = results["pivot_by_date"]
+        pivot_by_order = results["pivot_by_order"]
+        component_analysis = results["component_analysis"]
+        short_labels = results["short_labels"]
 
         # -------------------------------
         # الملخص السريع (عرض فقط)
         # -------------------------------
-        total_models = plan_df["Material"].nunique()
-        total_components = component_df["Component"].nunique()
+        # الإحصائيات تعمل على أكواد الـ category (أرقام) بدل مجموعات النصوص
+        plan_material_codes = present_codes(plan_df["Material"])
+        component_material_codes = present_codes(component_df["Material"])
+
+        total_models = len(plan_material_codes)
+        total_components = len(present_codes(component_df["Component"]))
         total_boms = len(component_df)
         empty_mrp_count = mrp_df["Component"].isna().sum() if not mrp_df.empty else 0
 
-        diff_uom = component_df.groupby("Component")["Component UoM"].nunique()
-        diff_uom = diff_uom[diff_uom > 1]
+        # أزواج (مكون، وحدة) المختلفة ثم عدها لكل مكون بدل nunique لكل مجموعة
+        uom_counts = component_df[["Component", "Component UoM"]].dropna().drop_duplicates().groupby("Component", observed=True).size()
+        diff_uom = uom_counts.index[uom_counts > 1]
         total_diff_uom = len(diff_uom)
 
         if total_diff_uom > 0:
-            diff_uom_str = ", ".join(map(str, diff_uom.index))
+            diff_uom_str = ", ".join(map(str, diff_uom))
             diff_uom_color = "red"
         else:
             diff_uom_str = "لا يوجد"
             diff_uom_color = "green"
 
-        missing_boms = set(plan_df["Material"]) - set(component_df["Material"])
+        # نفس الفئات للمادة في الخطة والمكونات فتتم المقارنة على الأكواد مباشرة
+        missing_codes = np.setdiff1d(plan_material_codes, component_material_codes, assume_unique=True)
+        missing_boms = plan_df["Material"].cat.categories[missing_codes]
         total_missing_boms = len(missing_boms)
         missing_boms_html = (
             f"<span style='color:red;'>{', '.join(map(str, missing_boms))}</span>"
-            if missing_boms else "<span style='color:green;'>لا يوجد</span>"
+            if total_missing_boms else "<span style='color:green;'>لا يوجد</span>"
         )
 
         # إحصائية جديدة لأنواع طلب المكونات
@@ -199,19 +565,13 @@ if uploaded_file:
         # إحصائية جديدة لأنواع طلب المكونات
         # -------------------------------
 
-        # خريطة الأكواد إلى النصوص
-        order_type_map = {
-            "F": "شراء",
-            "E": "تصنيع"
-        }
-
-        # إضافة عمود جديد بالوصف العربي
-        component_df["Order_Type_Label"] = component_df["Component Order Type"].map(order_type_map).fillna("غير محدد")
+        # أزواج (مكون، نوع طلب) المختلفة ثم value_counts واحد على الأكواد (F شراء / E تصنيع)
+        order_type_pairs = component_df[["Component", "Component Order Type"]].dropna(subset=["Component"]).drop_duplicates()
+        order_type_counts = order_type_pairs["Component Order Type"].value_counts(dropna=False)
 
-        # حساب الإحصائيات بعد توحيد الأعمدة
-        purchase_count = component_df.loc[component_df["Order_Type_Label"] == "شراء", "Component"].nunique()        # عدد المكونات شراء
-        manufacturing_count = component_df.loc[component_df["Order_Type_Label"] == "تصنيع", "Component"].nunique()  # عدد المكونات تصنيع
-        undefined_count = component_df.loc[component_df["Order_Type_Label"] == "غير محدد", "Component"].nunique()   # عدد المكونات غير محددة
+        purchase_count = int(order_type_counts.get("F", 0))        # عدد المكونات شراء
+        manufacturing_count = int(order_type_counts.get("E", 0))   # عدد المكونات تصنيع
+        undefined_count = order_type_pairs.loc[~order_type_pairs["Component Order Type"].isin(["F", "E"]), "Component"].nunique()   # عدد المكونات غير محددة
 
         # -------------------------------
         # إنشاء DataFrame للملخص لحفظه في الإكسل
@@ -279,126 +639,12 @@ if uploaded_file:
         </div>
         """, unsafe_allow_html=True)
 
-        # -------------------------------
-        # Need_By_Date
-        # -------------------------------
-        result_date = merged_df.groupby(
-            ["Component", "Component Description", "Component UoM", "Current Stock", "Component Order Type", "Date"]
-        )["Required Component Quantity"].sum().reset_index()
-
-        pivot_by_date = result_date.pivot_table(
-            index=["Component", "Component Description", "Component UoM", "Current Stock", "Component Order Type"],
-            columns="Date",
-            values="Required Component Quantity",
-            aggfunc="sum",
-            fill_value=0
-        ).reset_index()
-
-        if not mrp_df.empty:
-            pivot_by_date = pd.merge(
-                pivot_by_date,
-                mrp_df[["Component", "MRP Contor"]],
-                on="Component",
-                how="left"
-            )
-
-            # إعادة ترتيب الأعمدة
-            cols = pivot_by_date.columns.tolist()
-            fixed_order = ["Component", "Component Description", "MRP Contor", "Component UoM", "Current Stock", "Component Order Type"]
-            other_cols = [c for c in cols if c not in fixed_order]
-            pivot_by_date = pivot_by_date[fixed_order + other_cols]
-
-        # تنسيق أسماء الأعمدة (التواريخ تبقى dd mmm)
-        pivot_by_date.columns = [
-            col.strftime("%d %b") if isinstance(col, pd.Timestamp) else col
-            for col in pivot_by_date.columns
-        ]
-
-        # -------------------------------
-        # Need_By_Order Type
-        # -------------------------------
-        result_order = merged_df.groupby(
-            ["Component", "Component Description", "Component UoM", "Current Stock", "Component Order Type", "Order Type", "Date"]
-        )["Required Component Quantity"].sum().reset_index()
-
-        pivot_by_order = result_order.pivot_table(
-            index=["Component", "Component Description", "Component UoM", "Current Stock", "Component Order Type"],
-            columns=["Date", "Order Type"],
-            values="Required Component Quantity",
-            aggfunc="sum",
-            fill_value=0
-        ).reset_index()
-
-        pivot_by_order.columns = [
-            f"{col[1][0]} - {col[0].strftime('%d %b')}" if isinstance(col, tuple) and isinstance(col[0], pd.Timestamp)
-            else col if isinstance(col, str) else col[0]
-            for col in pivot_by_order.columns
-        ]
-
-        # 🔹 إضافة عمود MRP Contor
-        if not mrp_df.empty:
-            pivot_by_order = pivot_by_order.merge(mrp_df[["Component", "MRP Contor"]], on="Component", how="left")
-
-            merged_df = merged_df.merge(mrp_df[["Component", "MRP Contor"]], on="Component", how="left")
-
-            component_bom_map = merged_df.groupby(
-                ["MRP Contor", "Component", "Material", "Component Order Type"]
-            ).agg({
-                "Order Type": lambda x: ','.join(sorted(set(x))),
-                "Planned Quantity": "sum"
-            }).reset_index()
-
-            component_bom_map["OrderType_Quantity"] = component_bom_map["Order Type"] + " (" + component_bom_map["Planned Quantity"].astype(str) + ")"
-
-            component_bom_pivot = component_bom_map.pivot_table(
-                index=["MRP Contor", "Component", "Component Order Type"],
-                columns="Material",
-                values="OrderType_Quantity",
-                aggfunc=lambda x: ','.join(x),
-                fill_value=""
-            )
-
         # -------------------------------
         # تحليل الرصيد والمكونات الحرجة مع فلتر MRP Contor ونوع الطلب
         # -------------------------------
         st.markdown("---")
         st.subheader("📊 تحليل حرجية الرصيد ونسبة التغطية")
 
-        # حساب إجمالي الاحتياج والرصيد لكل مكون
-        component_analysis = merged_df.groupby([
-            "Component", "Component Description", "Component UoM", 
-            "Current Stock", "Component Order Type", "Hierarchy Level"
-        ]).agg({
-            "Required Component Quantity": "sum",
-            "Order Type": lambda x: ", ".join(sorted(set(x)))
-        }).reset_index()
-
-        # دمج بيانات MRP Contor إذا كانت موجودة
-        if not mrp_df.empty:
-            component_analysis = pd.merge(
-                component_analysis,
-                mrp_df[["Component", "MRP Contor"]],
-                on="Component",
-                how="left"
-            )
-            # استبدال القيم الفارغة بـ "غير محدد"
-            component_analysis["MRP Contor"] = component_analysis["MRP Contor"].fillna("غير محدد")
-        else:
-            component_analysis["MRP Contor"] = "غير محدد"
-
-        # حساب نسبة التغطية
-        component_analysis["Coverage Percentage"] = (component_analysis["Current Stock"] / component_analysis["Required Component Quantity"] * 100).round(1)
-        component_analysis["Coverage Status"] = component_analysis["Coverage Percentage"].apply(
-            lambda x: "🟢 كافية" if x >= 100 else "🟡 جزئية" if x >= 50 else "🔴 غير كافية"
-        )
-
-        # تحديد الأولوية بناء على نسبة التغطية والكمية المطلوبة
-        component_analysis["Priority"] = component_analysis.apply(
-            lambda row: "🔥 عاجل" if row["Coverage Percentage"] < 30 and row["Required Component Quantity"] > 1000 
-            else "⚠️ متوسط" if row["Coverage Percentage"] < 50 
-            else "✅ منخفض", 
-            axis=1
-        )
         # ----- فلاتر المستخدم -----
         mrp_controllers = sorted(component_analysis[col("mrp_controller")].dropna().unique())
         selected_mrp = st.multiselect("🔍 تصفية حسب MRP Contor:", options=mrp_controllers, default=mrp_controllers, help="اختر واحد أو أكثر من MRP Contor لعرضها")
@@ -410,11 +656,14 @@ if uploaded_file:
         hierarchy_levels = sorted(component_analysis[col("hierarchy_level")].dropna().unique())
         selected_levels = st.multiselect("🔍 تصفية حسب المستوى الهرمي (Hierarchy Level):", options=hierarchy_levels, default=hierarchy_levels, help="اختر واحد أو أكثر من المستوى لعرضها")
         # تطبيق الفلتر معاً
-        filtered_analysis = component_analysis[
-            (component_analysis[col("mrp_controller")].isin(selected_mrp)) &
-            (component_analysis[col("component_order_type")].isin(selected_order_types)) &
-            (component_analysis[col("hierarchy_level")].isin(selected_levels))
-        ]
+        filter_masks = build_filter_masks(digest, component_analysis)
+        filtered_analysis = component_analysis[apply_filter_masks(filter_masks, {
+            col("mrp_controller"): selected_mrp,
+            col("component_order_type"): selected_order_types,
+            col("hierarchy_level"): selected_levels
+        }, len(component_analysis))]
+        # مفتاح الكاش للرسوم البيانية = الاختيارات الحالية في الفلاتر
+        filter_key = (tuple(selected_mrp), tuple(selected_order_types), tuple(selected_levels))
 
 
         # عرض جدول التحليل
@@ -458,7 +707,7 @@ if uploaded_file:
         st.markdown("---")
         st.subheader("📊 تحليل المكونات حسب نوع الطلب")
 
-        order_type_stats = filtered_analysis.groupby("Component Order Type").agg({
+        order_type_stats = filtered_analysis.groupby("Component Order Type", observed=True).agg({
             "Component": "count",
             "Required Component Quantity": "sum",
             "Current Stock": "sum"
@@ -478,116 +727,35 @@ if uploaded_file:
 
         # رسم بياني لتوزيع نسبة التغطية حسب MRP Contor
         if len(selected_mrp) > 0:
-            fig_coverage = px.pie(
-                filtered_analysis, 
-                names="Coverage Status", 
-                title="توزيع المكونات حسب حالة التغطية",
-                color="Coverage Status",
-                color_discrete_map={"🟢 كافية": "green", "🟡 جزئية": "orange", "🔴 غير كافية": "red"}
-            )
+            fig_coverage = make_fig_coverage(digest, *filter_key, filtered_analysis)
             st.plotly_chart(fig_coverage, use_container_width=True)
 
         # رسم بياني للمكونات الأكثر حرجية مرتبة حسب كمية الطلب
-        top_critical = filtered_analysis.nsmallest(10, "Coverage Percentage")
-        if not top_critical.empty:
-            # تحويل الأعمدة إلى نص قبل الدمج
-            top_critical = top_critical.copy()
-            top_critical["Component"] = top_critical["Component"].astype(str)
-            top_critical["Component Description"] = top_critical["Component Description"].astype(str)
-            
-            # إنشاء تسمية مختصرة تجمع بين الكود والوصف
-            top_critical["Short_Label"] = top_critical["Component"] + " - " + top_critical["Component Description"].str[:20]
-            
-            # ترتيب المكونات حسب كمية الطلب (من الأكبر إلى الأصغر)
-            top_critical = top_critical.sort_values("Required Component Quantity", ascending=True)
-            
-            fig_critical = px.bar(
-                top_critical,
-                y="Short_Label",  # التسمية المختصرة على المحور Y
-                x="Required Component Quantity",  # كمية الطلب على المحور X
-                color="Coverage Percentage",  # التلوين حسب نسبة التغطية
-                orientation='h',  # رسم أفقي
-                title="أقل 10 مكونات في نسبة التغطية (مرتبة حسب كمية الطلب)",
-                labels={
-                    "Required Component Quantity": "كمية الطلب المطلوبة", 
-                    "Short_Label": "المكون", 
-                    "Coverage Percentage": "نسبة التغطية %",
-                    "MRP Contor": "MRP Controller"
-                },
-                hover_data={
-                    "Component": True,
-                    "Component Description": True,
-                    "Current Stock": True,
-                    "Coverage Percentage": ":.1f",
-                    "MRP Contor": True,
-                    "Component Order Type": True
-                },
-                color_continuous_scale="RdYlGn_r"  # مقياس ألوان عكسي (أحمر للأقل تغطية)
-            )
-            
-            # تخصيص التنسيق
-            fig_critical.update_traces(
-                hovertemplate=(
-                    "<b>%{customdata[0]}</b><br>"
-                    "الوصف: %{customdata[1]}<br>"
-                    "الرصيد الحالي: %{customdata[2]:,}<br>"
-                    "الطلب المطلوب: %{x:,}<br>"
-                    "نسبة التغطية: %{customdata[3]:.1f}%<br>"
-                    "MRP Controller: %{customdata[4]}<br>"
-                    "نوع الطلب: %{customdata[5]}"
-                )
-            )
-            
-            # تحسين تخطيط الرسم البياني
-            fig_critical.update_layout(
-                yaxis={'categoryorder':'total ascending'},  # ترتيب حسب القيمة
-                xaxis_title="كمية الطلب المطلوبة",
-                yaxis_title="المكون",
-                hovermode="closest",
-                coloraxis_colorbar=dict(title="نسبة التغطية %"),
-                height=500  # زيادة الارتفاع لعرض أفضل
-            )
-            
-            # إضافة تسميات القيم على الأعمدة
-            fig_critical.update_traces(
-                text=top_critical["Required Component Quantity"].apply(lambda x: f"{x:,.0f}"),
-                textposition='outside'
-            )
-            
+        fig_critical = make_fig_critical(digest, *filter_key, filtered_analysis, short_labels)
+        if fig_critical is not None:
             st.plotly_chart(fig_critical, use_container_width=True)
 
         # رسم بياني إضافي لتوزيع المكونات حسب MRP Contor والحالة
         if len(selected_mrp) > 0:
-            fig_mrp_coverage = px.sunburst(
-                filtered_analysis,
-                path=['MRP Contor', 'Coverage Status'],
-                values='Required Component Quantity',
-                title='توزيع المكونات حسب MRP Contor وحالة التغطية'
-            )
+            fig_mrp_coverage = make_fig_mrp_coverage(digest, *filter_key, filtered_analysis)
             st.plotly_chart(fig_mrp_coverage, use_container_width=True)
 
         # رسم بياني لتوزيع المكونات حسب نوع الطلب
-        fig_order_type = px.pie(
-            filtered_analysis, 
-            names="Component Order Type", 
-            title="توزيع المكونات حسب نوع الطلب",
-            color="Component Order Type"
-        )
+        fig_order_type = make_fig_order_type(digest, *filter_key, filtered_analysis)
         st.plotly_chart(fig_order_type, use_container_width=True)
 
         # -------------------------------
         # جدول الكميات الشهرية + الرسم البياني
         # -------------------------------
         if date_cols:
-            orders_summary = plan_df.melt(
-                id_vars=[col("material"), col("material_desc"), col("order_type")], 
-                value_vars=date_cols,
-                var_name="Month", 
-                value_name="Quantity"
+            # اسم الشهر يحسب مرة واحدة لكل عمود تاريخ بدل تحويل كل خلية بعد melt
+            month_names = pd.DatetimeIndex(date_cols).month_name()
+            pivot_df = (
+                plan_df.groupby(col("order_type"), observed=True)[date_cols].sum()
+                .T.groupby(month_names).sum()
+                .rename_axis("Month")
+                .reset_index()
             )
-            orders_summary["Month"] = pd.to_datetime(orders_summary["Month"]).dt.month_name()
-            orders_grouped = orders_summary.groupby(["Month", col("order_type")]).agg({"Quantity": "sum"}).reset_index()
-            pivot_df = orders_grouped.pivot_table(index="Month", columns=col("order_type"), values="Quantity", aggfunc="sum", fill_value=0).reset_index()
             
             if "E" not in pivot_df.columns: pivot_df["E"] = 0
             if "L" not in pivot_df.columns: pivot_df["L"] = 0
@@ -606,24 +774,17 @@ if uploaded_file:
             st.subheader("📊 توزيع الكميات الشهرية حسب نوع الأمر")
             html_table = "<table border='1' style='border-collapse: collapse; width:100%; text-align:center; color:green;'>"
             html_table += "<tr style='background-color:#4CAF50; color:white;'><th>الشهر</th><th>E</th><th>L</th><th>الإجمالي</th><th>E%</th><th>L%</th></tr>"
-            for _, row in pivot_df.iterrows():
-                html_table += "<tr>"
-                html_table += f"<td style='color:blue; font-weight:bold;'>{row['Month']}</td><td>{int(row.get('E', 0))}</td><td>{int(row.get('L', 0))}</td><td>{int(row.get('الإجمالي', 0))}</td><td>{row.get('E%', '')}</td><td>{row.get('L%', '')}</td>"
-                html_table += "</tr>"
+            html_table += "".join(
+                f"<tr><td style='color:blue; font-weight:bold;'>{month}</td><td>{int(e)}</td><td>{int(l)}</td><td>{int(total)}</td><td>{e_pct}</td><td>{l_pct}</td></tr>"
+                for month, e, l, total, e_pct, l_pct in zip(
+                    pivot_df["Month"], pivot_df["E"], pivot_df["L"], pivot_df["الإجمالي"], pivot_df["E%"], pivot_df["L%"]
+                )
+            )
             html_table += "</table>"
             st.markdown(f"<div style='direction:rtl;'>{html_table}</div>", unsafe_allow_html=True)
 
             # تحسين الرسم البياني بإضافة تسميات عربية
-            fig = px.bar(
-                pivot_df, 
-                x="Month", 
-                y=["E", "L"], 
-                barmode="group", 
-                text_auto=True, 
-                title="رسم بياني لتوزيع الكميات",
-                labels={"value": "الكمية", "variable": "نوع الأمر", "Month": "الشهر"},
-                template="streamlit"
-            )
+            fig = make_fig_monthly(digest, pivot_df)
             st.plotly_chart(fig, use_container_width=True)
             st.markdown("---")
 
@@ -642,9 +803,10 @@ if uploaded_file:
             # إضافة مؤشر التقدم هنا
             with st.spinner('⏳ جاري إنشاء الملفات وتجهيزها للتحميل...'):
                 current_date = datetime.datetime.now().strftime("%d_%b_%Y")
+                component_bom_pivot = build_bom_pivot(digest, merged_df, mrp_df)
 
                 excel_buffer = BytesIO()
-                with pd.ExcelWriter(excel_buffer, engine='openpyxl') as writer:
+                with pd.ExcelWriter(excel_buffer, engine='xlsxwriter') as writer:
                     # إضافة شيت الملخص أولاً
 
                     plan_df.to_excel(writer, sheet_name="Plan", index=False)
@@ -652,7 +814,8 @@ if uploaded_file:
                     pivot_by_date.to_excel(writer, sheet_name="Need_By_Date", index=False)
                     pivot_by_order.to_excel(writer, sheet_name="Need_By_Order Type", index=False)
                     component_analysis.to_excel(writer, sheet_name="Stock_Coverage_Analysis", index=False)
-                    component_bom_pivot.reset_index().to_excel(writer, sheet_name="Component_in_BOMs", index=False)
+                    if component_bom_pivot is not None:
+                        component_bom_pivot.reset_index().to_excel(writer, sheet_name="Component_in_BOMs", index=False)
                     component_df.to_excel(writer, sheet_name="Component", index=False)
                     if not mrp_df.empty:
                         mrp_df.to_excel(writer, sheet_name="MRP Contor", index=False)